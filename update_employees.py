@@ -7,17 +7,23 @@ docker run -it --rm --env-file env_file \
     -v ${PWD}:/app \
     atddocker/atd-knack-banner:production ./update_employees.py
 """
-import json
 import logging
 import os
 import secrets
 import string
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from datetime import date
 
 import knackpy
+import orjson
 import requests
 import wddx
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 # this can be changed to an env var to support multiple Knack apps
@@ -98,6 +104,9 @@ FIELD_MAP = [
     {"banner": "hiredate", "dts_portal": "", "hr": "field_264", "handler": format_date},
 ]
 
+# the primary key's FIELD_MAP entry maps app names to field names, like the
+# field dicts below
+PRIMARY_KEY_FIELD = next(field for field in FIELD_MAP if field.get("primary_key"))
 NAME_FIELD = {"hr": "field_17"}
 PASSWORD_FIELD = {"hr": "field_19", "dts_portal": ""}
 USER_STATUS_FIELD = {"hr": "field_20", "dts_portal": ""}
@@ -109,18 +118,57 @@ USER_ROLE_FIELD = {"hr": "field_21"}
 ACCOUNTS_OBJS = {"hr": "object_5"}
 
 
-def drop_empty_positions(records_hr, key="pidm"):
+@dataclass(frozen=True)
+class AppConfig:
+    """Knack object and field names for one knack app"""
+
+    obj: str
+    pk_field: str
+    status_field: str
+    password_field: str
+    email_field: str
+    created_date_field: str
+    class_field: str
+    separated_field: str
+    name_field: str
+    user_role_field: str
+
+
+CONFIG = AppConfig(
+    obj=ACCOUNTS_OBJS[KNACK_APP_NAME],
+    pk_field=PRIMARY_KEY_FIELD[KNACK_APP_NAME],
+    status_field=USER_STATUS_FIELD[KNACK_APP_NAME],
+    password_field=PASSWORD_FIELD[KNACK_APP_NAME],
+    email_field=EMAIL_FIELD[KNACK_APP_NAME],
+    created_date_field=CREATED_DATE_FIELD[KNACK_APP_NAME],
+    class_field=CLASS_FIELD[KNACK_APP_NAME],
+    separated_field=SEPARATED_FIELD[KNACK_APP_NAME],
+    name_field=NAME_FIELD[KNACK_APP_NAME],
+    user_role_field=USER_ROLE_FIELD[KNACK_APP_NAME],
+)
+
+# where snapshots of knack records are kept between runs
+SNAPSHOT_DIR = "cache"
+
+
+def get_session():
     """
-    Data from Banner contains vacant positions. so we remove them if the record has no
-    employee ID number, aka pidm
-    :returns: employee list from banner with vacant positions removed
+    Build a requests session with pooled keep-alive connections that retries
+    throttled and unavailable responses
+    :return: requests.Session
     """
-    return [r for r in records_hr if r.get(key)]
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503])
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
 
-def get_employee_data():
+def get_employee_data(session):
     """
     Request hr data from banner
+    :param session: requests session to make the request with
     :return: employee list from banner with vacant positions removed
     """
     BANNER_API_KEY = os.getenv("BANNER_API_KEY")
@@ -131,14 +179,15 @@ def get_employee_data():
         "setApiKey": BANNER_API_KEY,
     }
     #  get data in wddx format
-    res = requests.get(BANNER_URL, params=params)
+    res = session.get(BANNER_URL, params=params)
     #  use module to parse wddx tags
     #  and read data as list (which is actually a JSON string)
     json_raw = wddx.loads(res.text)
     #  remove weird leading slashes from data contents
     json_clean = json_raw[0].replace("//", "")
-    records_hr_unfiltered = json.loads(json_clean)
-    return drop_empty_positions(records_hr_unfiltered)
+    #  Data from Banner contains vacant positions. so we remove them if the record has
+    #  no employee ID number, aka pidm
+    return [r for r in orjson.loads(json_clean) if r.get("pidm")]
 
 
 def create_placeholder_email(record, name_field):
@@ -151,7 +200,8 @@ def create_placeholder_email(record, name_field):
     # first name in some records includes middle initial, we only want the first name
     first_name = record[name_field]["first"].split()[0]
     email = f"{first_name}.{record[name_field]['last']}@austintexas.gov"
-    email = email.replace(" ", "")
+    # banner emails are lowercased by to_email, so match them
+    email = email.replace(" ", "").lower()
     logging.info(f"setting placeholder email {email}")
     return email
 
@@ -164,28 +214,22 @@ def map_records(records_hr, field_map, knack_app_name):
     :param knack_app_name: string, which fields to map to, hr or dts
     :return: list, records from banner with knack field_names
     """
-    records_mapped = []
-    for record in records_hr:
-        record_mapped = {}
-        for field in field_map:
-            field_name_banner = field["banner"]
-            field_name_knack = field[knack_app_name]
-            handler = field.get("handler")
-            val_raw = record[field_name_banner]
-            val = val_raw if not handler else handler(val_raw)
-            record_mapped[field_name_knack] = val
-        records_mapped.append(record_mapped)
-    return records_mapped
-
-
-def get_primary_key_field(field_map, knack_app_name):
-    """
-    :param field_map: banner and knack field mappings
-    :param knack_app_name: knack app name to lookup in field_map
-    :return: primary key field name, string
-    """
-    pk_field = [f for f in field_map if f.get("primary_key")][0]
-    return pk_field[knack_app_name]
+    # resolve the field names and handlers once, rather than for every record
+    fields = [
+        (field["banner"], field[knack_app_name], field.get("handler"))
+        for field in field_map
+    ]
+    return [
+        {
+            field_name_knack: (
+                record[field_name_banner]
+                if not handler
+                else handler(record[field_name_banner])
+            )
+            for field_name_banner, field_name_knack, handler in fields
+        }
+        for record in records_hr
+    ]
 
 
 def is_different(record_hr, record_knack):
@@ -195,85 +239,73 @@ def is_different(record_hr, record_knack):
     :param record_knack: record from knack
     :return: True if any values do not match between records
     """
+    projected = {}
     for key, val in record_hr.items():
         val_knack = record_knack[key]
-        # unpack dicts, because the knack name field contains a "formatted_value" key
-        # which we want to ignore, because it's a field config prop that we don't
-        # need to stay in sync w/
+        # project dicts onto the banner keys, because the knack name field contains a
+        # "formatted_value" key which we want to ignore, because it's a field config
+        # prop that we don't need to stay in sync w/
         if isinstance(val, dict):
-            for _key, _val in val.items():
-                if val_knack[_key] != _val:
-                    # If banner does not have an email for a user in knack, we should use the
-                    # knack record email - and ignore this difference
-                    if (
-                        _key == "email"
-                        and _val == "no email"
-                        and val_knack[_key] != "no email"
-                    ):
-                        continue
-                    return True
-            continue
-        if val_knack != val:
-            return True
-    return False
-
-
-def build_payload(
-    records_knack,
-    records_hr,
-    pk_field,
-    status_field,
-    password_field,
-    created_date_field,
-    class_field,
-    separated_field,
-    user_role_field,
-    email_field,
-    name_field,
-    result,
-):
+            val_knack = {_key: val_knack[_key] for _key in val}
+            # If banner does not have an email for a user in knack, we should use the
+            # knack record email - and ignore this difference
+            if val.get("email") == "no email":
+                val_knack["email"] = "no email"
+        projected[key] = val_knack
+    return projected != record_hr
+
+
+def build_payload(records_knack, records_hr, config, result):
     """
     compare the hr records against knack records and return those records which
     are different or are new
-    :param records_knack: Records from knack (knackpy record format)
+    :param records_knack: Records from knack, as plain dicts of raw field values
     :param records_hr: field mapped records from banner
-    :param pk_field: field name for primary key in knack app
-    :param status_field: field name for status field in knack app
-    :param password_field: field for password in knack app
-    :param created_date_field: field for created date in knack app
-    :param class_field: field for class in knack app
-    :param separated_field: field if employee is separated in knack app
-    :param user_role_field: field in knack app to specify Staff, Supervisor etc
-    :param email_field: field in knack for email
-    :param name_field: field in knack for user's first and last name
+    :param config: AppConfig with the knack field names of the app
     :param result: dict to contain log of changes
     :return:
     """
+    # bind the field names once, they're used for every record below
+    pk_field = config.pk_field
+    status_field = config.status_field
+    password_field = config.password_field
+    created_date_field = config.created_date_field
+    class_field = config.class_field
+    separated_field = config.separated_field
+    user_role_field = config.user_role_field
+    email_field = config.email_field
+    name_field = config.name_field
+
     payload = []
     result["updates"] = []
     result["additions"] = []
     logging.info("Generating payload...")
+    # index both record sets by pk so matching is a dict lookup instead of a nested loop
+    knack_by_pk = {}
+    for r_knack in records_knack:
+        # if a pk is duplicated in knack, match the first record like we always have
+        knack_by_pk.setdefault(r_knack[pk_field], r_knack)
+    hr_pks = {r_hr[pk_field] for r_hr in records_hr}
     # for each banner record check knack records comparing pk to see if banner record exists in knack
     for r_hr in records_hr:
-        exists_in_knack = False
-        pk_hr = r_hr[pk_field]
-        for r_knack in records_knack:
-            pk_knack = r_knack[pk_field]
-            if pk_hr == pk_knack:
-                exists_in_knack = True
-                r_hr["id"] = r_knack["id"]
-                # Check if employee is marked as inactive in knack
-                # and update status_field to active since they are in banner
-                # unless they have been marked as Separated in knack
-                if r_knack[status_field] == "inactive" and not r_knack[separated_field]:
-                    r_hr[status_field] = "active"
-                # if any of the fields differ, add banner record to payload
-                if is_different(r_hr, r_knack):
-                    payload.append(r_hr)
-                    result["updates"].append((r_hr[name_field]))
-                break
+        r_knack = knack_by_pk.get(r_hr[pk_field])
+        if r_knack is not None:
+            r_hr["id"] = r_knack["id"]
+            # Check if employee is marked as inactive in knack
+            # and update status_field to active since they are in banner
+            # unless they have been marked as Separated in knack
+            if r_knack[status_field] == "inactive" and not r_knack[separated_field]:
+                r_hr[status_field] = "active"
+            # Knack won't allow records to be saved without valid emails, so updates
+            # for employees without an email in banner are skipped
+            if r_hr[email_field]["email"] == "no email":
+                continue
+            # if any of the fields differ, add banner record to payload
+            if is_different(r_hr, r_knack):
+                payload.append(r_hr)
+                result["updates"].append((r_hr[name_field]))
         # employee id number not in knack records
-        if not exists_in_knack:
+        else:
 
             # A password field is required when creating new users. so we generate one here.
             # The user is expected to sign in with Active Directory, they will not use this password.
@@ -292,19 +324,15 @@ def build_payload(
     result["inactivate"] = []
     # identify users which are no longer in Banner and therefore need to be deactivated
     for r_knack in records_knack:
-        matched = False
-        pk_knack = r_knack[pk_field]
-        for r_hr in records_hr:
-            pk_hr = r_hr[pk_field]
-            if pk_hr == pk_knack:
-                matched = True
-                break
+        # most knack users are already inactive or still in banner, so skip the
+        # inactive ones before looking anything up
+        if r_knack[status_field] == "inactive":
+            continue
         # if employee is a contractor, they wont be in banner. do not mark as inactive
-        if (
-            not matched
-            and r_knack[status_field] != "inactive"
-            and r_knack[class_field] != "Contract"
-        ):
+        if r_knack[class_field] != "Contract" and r_knack[pk_field] not in hr_pks:
+            # knack users without a valid email can't be saved, so leave them as is
+            if r_knack[email_field]["email"] == "no email":
+                continue
             record_id = r_knack["id"]
             inactivate = inactivate + 1
             # we include the email field in the payload only for logging purposes
@@ -316,23 +344,30 @@ def build_payload(
     return payload
 
 
+# i don't know what knack considers a special character, but it's something less
+# than string.punctuation
+SPECIAL_CHARS = "!#$%&"
+# a password needs at least one character from each of these
+PASSWORD_CHAR_CLASSES = (
+    string.ascii_lowercase,
+    string.ascii_uppercase,
+    string.digits,
+    SPECIAL_CHARS,
+)
+PASSWORD_CHARS = "".join(PASSWORD_CHAR_CLASSES)
+
+
 def random_password(numchars=32):
     """generate a random password with at least 1 lowercase, uppercase, and special
     char"""
-    # i don't know what knack considers a special character, but it's something less
-    # than string.punctuation
-    special_chars = "!#$%&"
-    chars = special_chars + string.digits + string.ascii_letters
-    while True:
-        password = "".join(secrets.choice(chars) for i in range(numchars))
-        if (
-            any(c.islower() for c in password)
-            and any(c.isupper() for c in password)
-            and any(c.isdigit() for c in password)
-            and any(c in special_chars for c in password)
-        ):
-            break
-    return password
+    # draw one character from each class so the password always qualifies, fill the
+    # rest from all of them, then shuffle so the required ones aren't up front
+    password = [secrets.choice(char_class) for char_class in PASSWORD_CHAR_CLASSES]
+    password += [
+        secrets.choice(PASSWORD_CHARS) for i in range(numchars - len(password))
+    ]
+    secrets.SystemRandom().shuffle(password)
+    return "".join(password)
 
 
 def set_passwords(records, password_field):
@@ -344,25 +379,77 @@ def set_passwords(records, password_field):
     return
 
 
-def remove_empty_emails(payload, email_field, name_field):
+def load_knack_snapshot(path, max_age):
     """
-    Knack won't allow records to be added without valid emails
-    :param payload: list of records payload
-    :param email_field: email field to check from knack app
-    :param name_field: name field for easier to read logging
-    :return: list of payload records with valid emails
+    Knack records are cached between runs that made no changes in Knack, so that a
+    frequently scheduled sync doesn't have to fetch them all again
+    :param path: snapshot file path
+    :param max_age: seconds a snapshot may be used for, 0 disables the cache
+    :return: list of knack records, or None if there is no usable snapshot
     """
-    cleaned_payload = []
-    for r in payload:
-        try:
-            if r[email_field]["email"] != "no email":
-                cleaned_payload.append(r)
-                logging.info(f"Updating: {r[name_field]}")
-        except KeyError:
-            # if an item in the payload doesn't have an email
-            # that payload item is being set as inactive
-            cleaned_payload.append(r)
-    return cleaned_payload
+    if not max_age or not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as fin:
+            snapshot = orjson.loads(fin.read())
+        timestamp = snapshot["timestamp"]
+        records_knack = snapshot["records"]
+    except (OSError, orjson.JSONDecodeError, KeyError, TypeError):
+        # an unreadable snapshot is just a cache miss, we fetch from knack instead
+        logging.warning(f"Ignoring unreadable snapshot {path}")
+        return None
+    if time.time() - timestamp > max_age:
+        return None
+    return records_knack
+
+
+def save_knack_snapshot(path, records_knack):
+    """
+    :param path: snapshot file path
+    :param records_knack: knack records as plain dicts
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temp file and swap it in, so a run that dies mid-write can't leave a
+    # truncated snapshot behind
+    path_tmp = f"{path}.tmp"
+    with open(path_tmp, "wb") as fout:
+        fout.write(orjson.dumps({"timestamp": time.time(), "records": records_knack}))
+    os.replace(path_tmp, path)
+
+
+class RateLimiter:
+    """Spaces out calls shared by several threads to at most per_second a second.
+    A per_second of 0 or less turns the limit off."""
+
+    def __init__(self, per_second):
+        self.interval = 1 / per_second if per_second > 0 else 0
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        """block until the caller's turn comes up"""
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def write_record(app, limiter, stop, **kwargs):
+    """
+    Create or update a knack record once the rate limiter allows it
+    :param app: knackpy App
+    :param limiter: RateLimiter shared by all writer threads
+    :param stop: threading.Event set once a write has failed fatally
+    :param kwargs: data, method and obj, passed on to app.record
+    :return: the knack record, or None if the write was called off
+    """
+    limiter.wait()
+    # a fatal error may have come up while we were waiting our turn
+    if stop.is_set():
+        return None
+    return app.record(**kwargs)
 
 
 def format_errors(error_list, record):
@@ -376,70 +463,104 @@ def format_errors(error_list, record):
 def main():
     KNACK_APP_ID = os.getenv("KNACK_APP_ID")
     KNACK_API_KEY = os.getenv("KNACK_API_KEY")
+    KNACK_CONCURRENCY = int(os.getenv("KNACK_CONCURRENCY") or 5)
+    # knack allows 10 api requests per second per app, 0 turns off our throttle
+    KNACK_REQUESTS_PER_SECOND = float(os.getenv("KNACK_REQUESTS_PER_SECOND") or 10)
+    SYNC_TOLERANCE = int(os.getenv("SYNC_TOLERANCE") or 0)
 
     result = {}
 
-    logging.info("Getting employee data from Banner...")
-    records_hr_banner = get_employee_data()
+    # banner and knack don't depend on each other, so fetch from banner in the
+    # background while we get the knack records
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        logging.info("Getting employee data from Banner...")
+        session = get_session()
+        banner_future = executor.submit(get_employee_data, session)
+
+        # use knackpy to get records from knack hr object
+        knack_obj = CONFIG.obj
+        logging.info(f"Initializing Knack app...")
+        app = knackpy.App(app_id=KNACK_APP_ID, api_key=KNACK_API_KEY)
+        snapshot_path = os.path.join(SNAPSHOT_DIR, f"{KNACK_APP_ID}_{knack_obj}.json")
+        records_knack = load_knack_snapshot(snapshot_path, SYNC_TOLERANCE)
+        from_snapshot = records_knack is not None
+        if from_snapshot:
+            logging.info(f"Using cached employee data from {snapshot_path}...")
+        else:
+            logging.info(f"Getting employee data from Knack app...")
+            # knackpy records look up fields with a linear scan, so flatten them to
+            # plain dicts of raw values once
+            records_knack = [
+                record.format(keys=False, values=False)
+                for record in app.get(knack_obj)
+            ]
+        logging.info(f"Got {len(records_knack)} records from Knack.")
+
+        records_hr_banner = banner_future.result()
 
     logging.info(f"Got {len(records_hr_banner)} records from Banner.")
     records_mapped = map_records(records_hr_banner, FIELD_MAP, KNACK_APP_NAME)
 
-    # use knackpy to get records from knack hr object
-    knack_obj = ACCOUNTS_OBJS[KNACK_APP_NAME]
-    logging.info(f"Initializing Knack app...")
-    app = knackpy.App(app_id=KNACK_APP_ID, api_key=KNACK_API_KEY)
-    logging.info(f"Getting employee data from Knack app...")
-    records_knack = app.get(knack_obj)
-    logging.info(f"Got {len(records_knack)} records from Knack.")
-
-    pk_field = get_primary_key_field(FIELD_MAP, KNACK_APP_NAME)
-    status_field = USER_STATUS_FIELD[KNACK_APP_NAME]
-    password_field = PASSWORD_FIELD[KNACK_APP_NAME]
-    email_field = EMAIL_FIELD[KNACK_APP_NAME]
-    created_date_field = CREATED_DATE_FIELD[KNACK_APP_NAME]
-    class_field = CLASS_FIELD[KNACK_APP_NAME]
-    separated_field = SEPARATED_FIELD[KNACK_APP_NAME]
-    name_field = NAME_FIELD[KNACK_APP_NAME]
-    user_role_field = USER_ROLE_FIELD[KNACK_APP_NAME]
-
-    payload = build_payload(
-        records_knack,
-        records_mapped,
-        pk_field,
-        status_field,
-        password_field,
-        created_date_field,
-        class_field,
-        separated_field,
-        user_role_field,
-        email_field,
-        name_field,
-        result,
-    )
-    cleaned_payload = remove_empty_emails(payload, email_field, name_field)
-
-    logging.info(f"{len(cleaned_payload)} total records to process in Knack.")
+    payload = build_payload(records_knack, records_mapped, CONFIG, result)
+    logging.info(f"{len(payload)} total records to process in Knack.")
+
+    # a snapshot only matches knack until we write to it, and a reused snapshot keeps
+    # its original timestamp so that it still expires
+    if payload and os.path.exists(snapshot_path):
+        os.remove(snapshot_path)
+    elif not payload and SYNC_TOLERANCE and not from_snapshot:
+        save_knack_snapshot(snapshot_path, records_knack)
 
     result["errors"] = []
 
-    for record in cleaned_payload:
-        method = "update" if record.get("id") else "create"
+    # knackpy rebuilds every locally stored record of the object after each write. we
+    # don't read them again, so drop its copy rather than pay for that on every record
+    # and have the writer threads all mutate it
+    app.data.pop(knack_obj, None)
+
+    # the writer threads share one limiter so the pool stays under knack's rate limit
+    limiter = RateLimiter(KNACK_REQUESTS_PER_SECOND)
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=KNACK_CONCURRENCY) as executor:
+        futures = {}
+        for record in payload:
+            method = "update" if record.get("id") else "create"
+            logging.info(f"{method} {record[CONFIG.email_field]['email']}")
+            future = executor.submit(
+                write_record,
+                app,
+                limiter,
+                stop,
+                data=record,
+                method=method,
+                obj=knack_obj,
+            )
+            futures[future] = (record, method)
+
         try:
-            logging.info(f"{method} {record[email_field]['email']}")
-            app.record(data=record, method=method, obj=knack_obj)
-        except requests.HTTPError as e:
-            if e.response.status_code == 400:
-                if record["field_230"] == "Crossing Guard":
-                    logging.info(f"Error with Crossing Guard record {record[email_field]['email']}, skipped record {method}")
-                    continue
-                else:
-                    errors_list = e.response.json()["errors"]
-                    result["errors"].append(format_errors(errors_list, record))
-                    continue
-            else:
-                # if we get an error that is not 400, that error is raised, but we won't see previous errors
-                raise e
+            for future in as_completed(futures):
+                record, method = futures[future]
+                try:
+                    future.result()
+                except requests.HTTPError as e:
+                    if e.response.status_code == 400:
+                        if record["field_230"] == "Crossing Guard":
+                            logging.info(f"Error with Crossing Guard record {record[CONFIG.email_field]['email']}, skipped record {method}")
+                            continue
+                        else:
+                            errors_list = e.response.json()["errors"]
+                            result["errors"].append(format_errors(errors_list, record))
+                            continue
+                    else:
+                        # if we get an error that is not 400, that error is raised, but we won't see previous errors
+                        raise e
+        except BaseException:
+            # drop the writes that haven't started yet on any error we don't handle,
+            # like the serial loop did
+            stop.set()
+            for pending in futures:
+                pending.cancel()
+            raise
 
     logging.info(f"Update complete. {len(result['errors'])} errors.")
     logging.info(result)